@@ -1,168 +1,592 @@
-from flask import Flask, request, jsonify
+import sys
+
+# gevent must patch the standard library before anything else imports socket/ssl
+USE_GEVENT = __name__ == '__main__' and '--use-gevent' in sys.argv
+if USE_GEVENT:
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, request
+import atexit
+import hashlib
+import math
 import os
+import re
 from datetime import datetime
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+import dns.exception
+import dns.resolver
 from dotenv import load_dotenv
-import requests
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+import urllib3
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env file if it exists
 load_dotenv()
 
 app = Flask(__name__)
+# Number of proxies in front of the app whose X-Forwarded-For entries are trusted
+# (1 on Render). Left at 0 when clients connect directly, so the header can't be spoofed
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+# Reject oversized bodies before they are read and parsed
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; records are handed to a background listener so handler
+# I/O never blocks a request
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler()
+_log_listener = QueueListener(_log_queue, _log_handler)
+LOG_LEVEL = (os.getenv('LOG_LEVEL') or 'WARNING').upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(level=LOG_LEVEL if _log_level_valid else logging.WARNING,
+                    handlers=[QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
+if not _log_level_valid:
+    logger.warning("Unknown LOG_LEVEL %r, falling back to WARNING", LOG_LEVEL)
 
 # Resend configuration
 RESEND_API_KEY = os.getenv('RESEND_API_KEY')
 SENDER_EMAIL = os.getenv('SENDER_EMAIL')
 SENDER_NAME = os.getenv('SENDER_NAME', 'Contact Form')
+RESEND_URL = "https://api.resend.com/emails"
+RESEND_BATCH_URL = "https://api.resend.com/emails/batch"
+RESEND_HEADERS = {
+    "Authorization": f"Bearer {RESEND_API_KEY}",
+    "Content-Type": "application/json"
+}
+FROM_HEADER = f"{SENDER_NAME} <{SENDER_EMAIL}>"
+
+# Per-client rate limiting (token bucket keyed by IP)
+# RATE_LIMIT_PER_MINUTE=0 disables limiting; invalid values fall back to the defaults
+RATE_LIMIT_PER_MINUTE = float(os.getenv('RATE_LIMIT_PER_MINUTE', '10'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '5'))
+RATE_LIMIT_MAX_KEYS = 10000
+
+if RATE_LIMIT_PER_MINUTE < 0:
+    logger.warning("RATE_LIMIT_PER_MINUTE must not be negative, falling back to 10")
+    RATE_LIMIT_PER_MINUTE = 10.0
+if RATE_LIMIT_BURST < 1:
+    logger.warning("RATE_LIMIT_BURST must be at least 1, falling back to 5")
+    RATE_LIMIT_BURST = 5.0
+
+_rate_buckets = OrderedDict()
+_rate_lock = threading.Lock()
+
+def take_rate_token(key):
+    """
+    Spend a token from the key's bucket, returning 0 if allowed or the seconds to wait
+    """
+    if not RATE_LIMIT_PER_MINUTE:
+        return 0
+
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    now = time.monotonic()
+    with _rate_lock:
+        tokens, last = _rate_buckets.pop(key, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * rate)
+        allowed = tokens >= 1
+        # Rejected requests also spend a token so retry storms stay throttled
+        tokens = max(tokens - 1, -RATE_LIMIT_BURST)
+        _rate_buckets[key] = (tokens, now)
+        if len(_rate_buckets) > RATE_LIMIT_MAX_KEYS:
+            _rate_buckets.popitem(last=False)
+
+    if allowed:
+        return 0
+    return math.ceil((1 - tokens) / rate)
+
+def json_response(payload, status):
+    """
+    Build a JSON response serialized with orjson
+    """
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
+# Email body, formatted per request with format_map
+BODY_TMPL = (
+    "Contact Form Submission\n"
+    "\n"
+    "From: {name}\n"
+    "Email: {email}\n"
+    "Message:\n"
+    "{message}\n"
+    "\n"
+    "---\n"
+    "Sent at: {ts}"
+)
+
+# (second, formatted timestamp), swapped as a whole so readers never see a torn pair
+_ts_cache = (0, "")
+
+def _fmt_now():
+    """
+    Current local time as YYYY-MM-DD HH:MM:SS, formatted at most once per second
+    """
+    global _ts_cache
+    now = int(time.time())
+    cached = _ts_cache
+    if cached[0] != now:
+        cached = (now, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)))
+        _ts_cache = cached
+    return cached[1]
+
+REQUIRED_FIELDS = ('name', 'email', 'message', 'target_email')
+FIELD_MAX_LENGTHS = {'name': 200, 'email': 320, 'message': 10000, 'target_email': 320}
+
+# Compiled once at import so validation never recompiles the pattern
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def is_valid_email(address):
+    """
+    Check that an address looks like local@domain.tld
+    """
+    # Cheap prefilter so obviously bad input skips the regex
+    return '@' in address and EMAIL_RE.match(address) is not None
+
+# MX lookups are cached per domain and refreshed every MX_CACHE_TTL seconds
+MX_CACHE_TTL = 300
+
+@lru_cache(maxsize=1024)
+def _lookup_mx(domain, ttl_bucket):
+    """
+    Resolve a domain's MX records, raising NXDOMAIN so missing domains are never cached
+    """
+    try:
+        dns.resolver.resolve(domain, 'MX', lifetime=3)
+    except dns.resolver.NoAnswer:
+        # No MX record, mail is delivered to the domain's address record instead
+        pass
+    return True
+
+def domain_accepts_mail(domain):
+    """
+    Check that a recipient domain exists before spending a Resend call on it
+    """
+    try:
+        return _lookup_mx(domain.lower(), int(time.time() // MX_CACHE_TTL))
+    except dns.resolver.NXDOMAIN:
+        return False
+    except dns.exception.DNSException as e:
+        # Don't reject emails because of a transient DNS failure
+        logger.warning("MX lookup failed for %s: %s", domain, e)
+        return True
+
+# Shared connection pool so connections to Resend are kept alive between sends.
+# Sends are not idempotent, so only retry when Resend cannot have accepted the
+# email: failed connects and 429 responses. Read errors and 5xx are never retried
+# since the email may already be on its way.
+HTTP = urllib3.PoolManager(
+    num_pools=4,
+    maxsize=64,
+    retries=Retry(
+        total=2,
+        read=False,
+        other=0,
+        backoff_factor=0.2,
+        status_forcelist=[429],
+        allowed_methods=frozenset(["POST"]),
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+)
+HTTP_TIMEOUT = urllib3.Timeout(connect=3, read=10)
+# Upper bound on one Resend call: 3 connect attempts, one read and the retry backoff
+UPSTREAM_MAX_TIME = 3 * 3 + 10 + 1
+
+# Outgoing emails are coalesced into Resend batch requests
+BATCH_MAX_SIZE = 100  # Resend accepts at most 100 emails per batch
+BATCH_MAX_BYTES = 500 * 1000  # Resend's limit on a batch request's payload
+BATCH_WINDOW = 0.05  # Seconds to wait for more emails before flushing
+# Seconds a request waits for its email to be picked up by the batch worker
+SEND_TIMEOUT = 45
+# Total time a request waits for its send: once picked up, an email goes through
+# at most a batch call and, if the batch fails validation, its own call
+SEND_DEADLINE = SEND_TIMEOUT + 2 * UPSTREAM_MAX_TIME
+SEND_QUEUE = queue.Queue(maxsize=1000)
+
+# Emails from a batch that failed validation are re-sent individually here so the
+# batch worker can keep draining the queue
+_split_executor = ThreadPoolExecutor(max_workers=8)
+
+_batch_worker = None
+_batch_worker_lock = threading.Lock()
+
+class SendQueueFull(Exception):
+    """
+    Raised when the outgoing email queue is saturated
+    """
+
+def _ensure_batch_worker():
+    """
+    Start the batch worker thread if it is not running (e.g. after a fork)
+    """
+    global _batch_worker
+    if _batch_worker is not None and _batch_worker.is_alive():
+        return
+    with _batch_worker_lock:
+        if _batch_worker is None or not _batch_worker.is_alive():
+            _batch_worker = threading.Thread(target=_batch_worker_loop, daemon=True)
+            _batch_worker.start()
+
+def _batch_worker_loop():
+    """
+    Drain the send queue in batches of up to BATCH_MAX_SIZE emails, BATCH_MAX_BYTES
+    of JSON or BATCH_WINDOW seconds, whichever comes first
+    """
+    pending = None
+    while True:
+        items = []
+        size = 2  # Brackets around the JSON array
+        deadline = None
+        while len(items) < BATCH_MAX_SIZE:
+            if pending is not None:
+                item, pending = pending, None
+            elif not items:
+                item = SEND_QUEUE.get()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = SEND_QUEUE.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            # Carry an email that would overflow the batch over to the next one
+            if items and size + len(item[0]) + 1 > BATCH_MAX_BYTES:
+                pending = item
+                break
+            # Skip emails whose request already gave up waiting
+            if not item[1].set_running_or_notify_cancel():
+                continue
+            if not items:
+                deadline = time.monotonic() + BATCH_WINDOW
+            items.append(item)
+            size += len(item[0]) + 1
+        _send_batch(items)
+
+def _post_resend(url, body):
+    """
+    POST a JSON body to Resend, returning the response status or None on error
+    """
+    try:
+        response = HTTP.request('POST', url, body=body, headers=RESEND_HEADERS, timeout=HTTP_TIMEOUT)
+        if response.status != 200:
+            logger.error("Resend error: %s - %s", response.status, response.data.decode('utf-8', 'replace'))
+        return response.status
+    except Exception as e:
+        logger.error("Failed to send email via Resend: %s", e)
+        return None
+
+def _send_single(body, future):
+    """
+    Send one email on its own and resolve its future
+    """
+    future.set_result(_post_resend(RESEND_URL, body) == 200)
+
+def _send_batch(items):
+    """
+    Send queued emails with one batch request and resolve their futures
+    """
+    if len(items) == 1:
+        _send_single(*items[0])
+        return
+
+    status = _post_resend(RESEND_BATCH_URL, b'[' + b','.join(body for body, _ in items) + b']')
+    if status in (400, 422):
+        # A batch failing validation is rejected as a whole, so retry individually
+        # to isolate bad emails; rate limits and outages fail the whole batch
+        for body, future in items:
+            _split_executor.submit(_send_single, body, future)
+        return
+
+    for _, future in items:
+        future.set_result(status == 200)
 
 def send_email_resend(name, sender_email, message, target_email):
     """
     Send email using Resend API
     """
+    data = {
+        "from": FROM_HEADER,
+        "to": [target_email],
+        "subject": name,  # Subject is the sender's name
+        "text": BODY_TMPL.format_map({
+            'name': name,
+            'email': sender_email,
+            'message': message,
+            'ts': _fmt_now()
+        })
+    }
+
+    _ensure_batch_worker()
+    future = Future()
     try:
-        url = "https://api.resend.com/emails"
-        
-        headers = {
-            "Authorization": f"Bearer {RESEND_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "from": f"{SENDER_NAME} <{SENDER_EMAIL}>",
-            "to": [target_email],
-            "subject": name,  # Subject is the sender's name
-            "text": f"""
-Contact Form Submission
-
-From: {name}
-Email: {sender_email}
-Message:
-{message}
-
----
-Sent at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-            """.strip()
-        }
-        
-        response = requests.post(url, json=data, headers=headers)
-        
-        if response.status_code == 200:
-            logger.info(f"Email sent successfully from {name} ({sender_email}) to {target_email}")
+        SEND_QUEUE.put_nowait((orjson.dumps(data), future))
+    except queue.Full:
+        raise SendQueueFull()
+
+    try:
+        try:
+            sent = future.result(timeout=SEND_TIMEOUT)
+        except FutureTimeoutError:
+            if future.cancel():
+                logger.error("Timed out waiting to send email to %s", target_email)
+                return False
+            # Already handed to Resend, so wait for the real outcome instead of
+            # reporting a failure the client would retry into a duplicate
+            try:
+                sent = future.result(timeout=SEND_DEADLINE - SEND_TIMEOUT)
+            except FutureTimeoutError:
+                logger.error("Timed out waiting for Resend to accept email to %s", target_email)
+                return False
+
+        if sent:
+            logger.debug("Email sent from %s (%s) to %s", name, sender_email, target_email)
             return True
-        else:
-            logger.error(f"Resend error: {response.status_code} - {response.text}")
-            return False
-        
+        return False
+
     except Exception as e:
-        logger.error(f"Failed to send email via Resend: {str(e)}")
+        logger.error("Failed to send email via Resend: %s", e)
         return False
 
+def send_and_respond(name, sender_email, message, target_email):
+    """
+    Send an email and build the (payload, status) pair for the response
+    """
+    try:
+        sent = send_email_resend(name, sender_email, message, target_email)
+    except SendQueueFull:
+        logger.warning("Send queue is full, rejecting request")
+        return {
+            'success': False,
+            'error': 'Server is busy, please try again later'
+        }, 503
+
+    if sent:
+        return {
+            'success': True,
+            'message': 'Email sent successfully'
+        }, 200
+    else:
+        return {
+            'success': False,
+            'error': 'Failed to send email'
+        }, 500
+
+# Identical submissions within DEDUP_WINDOW seconds are only sent once
+DEDUP_WINDOW = 5
+DEDUP_MAX_ENTRIES = 4096
+_DEDUP_KEY = os.urandom(16)
+
+_recent_sends = OrderedDict()
+_dedup_lock = threading.Lock()
+
+def _submission_key(*fields):
+    """
+    Hash the submitted fields into a fixed-size dedup key
+    """
+    h = hashlib.blake2b(digest_size=16, key=_DEDUP_KEY)
+    for field in fields:
+        encoded = field.encode('utf-8', 'surrogatepass')
+        h.update(len(encoded).to_bytes(8, 'big'))
+        h.update(encoded)
+    return h.digest()
+
+def send_deduplicated(name, sender_email, message, target_email):
+    """
+    Send an email unless an identical submission is in flight or was just sent
+    """
+    key = _submission_key(name, sender_email, message, target_email)
+    now = time.monotonic()
+    with _dedup_lock:
+        entry = _recent_sends.get(key)
+        if entry is not None and (not entry[1].done() or now - entry[0] < DEDUP_WINDOW):
+            future = entry[1]
+            owner = False
+        else:
+            future = Future()
+            owner = True
+            _recent_sends[key] = (now, future)
+            _recent_sends.move_to_end(key)
+            while len(_recent_sends) > DEDUP_MAX_ENTRIES:
+                _recent_sends.popitem(last=False)
+
+    if not owner:
+        logger.debug("Duplicate submission from %s to %s, reusing result", sender_email, target_email)
+        try:
+            return future.result(timeout=SEND_DEADLINE)
+        except FutureTimeoutError:
+            logger.error("Timed out waiting on duplicate submission to %s", target_email)
+            return {
+                'success': False,
+                'error': 'Failed to send email'
+            }, 500
+
+    try:
+        result = send_and_respond(name, sender_email, message, target_email)
+    except Exception as e:
+        result = None
+        future.set_exception(e)
+        raise
+    finally:
+        with _dedup_lock:
+            if _recent_sends.get(key, (None, None))[1] is future:
+                if result is not None and result[1] == 200:
+                    # Start the dedup window from when the send completed
+                    _recent_sends[key] = (time.monotonic(), future)
+                else:
+                    # Let the client retry failed sends right away
+                    del _recent_sends[key]
+
+    future.set_result(result)
+    return result
+
 @app.route('/send-email', methods=['POST'])
 def handle_email():
     """
     Handle incoming JSON requests and send emails
     """
     try:
+        # Throttle each client before doing any work on its request
+        retry_after = take_rate_token(request.remote_addr)
+        if retry_after:
+            logger.debug("Rate limit exceeded for %s", request.remote_addr)
+            response = json_response({
+                'success': False,
+                'error': 'Too many requests, please try again later'
+            }, 429)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
         # Check if request contains JSON
-        if not request.is_json:
-            return jsonify({
+        if request.mimetype != 'application/json':
+            return json_response({
                 'success': False,
                 'error': 'Content-Type must be application/json'
-            }), 400
+            }, 400)
         
-        data = request.get_json()
+        try:
+            data = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            data = None
+        except RequestEntityTooLarge:
+            return json_response({
+                'success': False,
+                'error': 'Request body is too large'
+            }, 413)
+
+        if not isinstance(data, dict):
+            return json_response({
+                'success': False,
+                'error': 'Request body must be a JSON object'
+            }, 400)
         
-        # Validate required fields
-        required_fields = ['name', 'email', 'message', 'target_email']
-        missing_fields = [field for field in required_fields if not data.get(field)]
+        # Validate and strip required fields in a single pass
+        fields = {}
+        missing_fields = []
+        oversized_fields = []
+        for field in REQUIRED_FIELDS:
+            value = data.get(field)
+            if isinstance(value, str):
+                value = value.strip()
+            if not value or not isinstance(value, str):
+                missing_fields.append(field)
+            elif len(value) > FIELD_MAX_LENGTHS[field]:
+                oversized_fields.append(field)
+            else:
+                fields[field] = value
         
         if missing_fields:
-            return jsonify({
+            return json_response({
                 'success': False,
                 'error': f'Missing required fields: {", ".join(missing_fields)}'
-            }), 400
+            }, 400)
+
+        if oversized_fields:
+            return json_response({
+                'success': False,
+                'error': f'Fields too long: {", ".join(oversized_fields)}'
+            }, 413)
         
         # Check if email configuration is set
         if not all([RESEND_API_KEY, SENDER_EMAIL]):
             logger.error("Resend configuration not properly set")
-            return jsonify({
+            return json_response({
                 'success': False,
                 'error': 'Server email configuration error'
-            }), 500
+            }, 500)
         
-        # Extract data
-        name = data['name'].strip()
-        email = data['email'].strip()
-        message = data['message'].strip()
-        target_email = data['target_email'].strip()
-        
-        # Basic validation
-        if not name or not email or not message or not target_email:
-            return jsonify({
-                'success': False,
-                'error': 'All fields must contain valid content'
-            }), 400
+        name = fields['name']
+        email = fields['email']
+        message = fields['message']
+        target_email = fields['target_email']
         
         # Basic email validation
-        if '@' not in email or '.' not in email:
-            return jsonify({
+        if not is_valid_email(email):
+            return json_response({
                 'success': False,
                 'error': 'Invalid sender email format'
-            }), 400
+            }, 400)
             
-        if '@' not in target_email or '.' not in target_email:
-            return jsonify({
+        if not is_valid_email(target_email):
+            return json_response({
                 'success': False,
                 'error': 'Invalid target email format'
-            }), 400
-        
-        # Send email
-        if send_email_resend(name, email, message, target_email):
-            return jsonify({
-                'success': True,
-                'message': 'Email sent successfully'
-            }), 200
-        else:
-            return jsonify({
+            }, 400)
+
+        if not domain_accepts_mail(target_email.rsplit('@', 1)[1]):
+            return json_response({
                 'success': False,
-                'error': 'Failed to send email'
-            }), 500
+                'error': 'Target email domain does not exist'
+            }, 400)
+        
+        # Send email, collapsing identical submissions that arrive close together
+        payload, status = send_deduplicated(name, email, message, target_email)
+        return json_response(payload, status)
             
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}")
-        return jsonify({
+        logger.error("Error processing request: %s", e)
+        return json_response({
             'success': False,
             'error': 'Internal server error'
-        }), 500
+        }, 500)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """
     Simple health check endpoint
     """
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'email_service': 'Resend'
-    }), 200
+    }, 200)
 
 @app.route('/', methods=['GET'])
 def index():
     """
     Basic info endpoint
     """
-    return jsonify({
+    return json_response({
         'service': 'Email Middleware (Resend)',
         'version': '1.0',
         'endpoints': {
             'POST /send-email': 'Send email from contact form',
             'GET /health': 'Health check'
         }
-    }), 200
+    }, 200)
 
 if __name__ == '__main__':
     # Check if required environment variables are set
@@ -172,6 +596,10 @@ if __name__ == '__main__':
         print("- SENDER_EMAIL: The verified sender email address")
         print("\nOptional environment variables:")
         print("- SENDER_NAME: The sender name (default: Contact Form)")
+        print("- RATE_LIMIT_PER_MINUTE: Emails allowed per client per minute, 0 disables limiting (default: 10)")
+        print("- RATE_LIMIT_BURST: Emails a client may send at once, at least 1 (default: 5)")
+        print("- LOG_LEVEL: Logging level (default: WARNING)")
+        print("- TRUSTED_PROXY_COUNT: Proxies in front of the app to trust for client IPs (default: 0)")
         exit(1)
     
     print(f"Starting email middleware with Resend...")
@@ -181,4 +609,9 @@ if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     
     # Run the app
-    app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
+    if USE_GEVENT:
+        from gevent.pywsgi import WSGIServer
+        print(f"Serving with gevent on port {port}")
+        WSGIServer(('0.0.0.0', port), app).serve_forever()
+    else:
+        app.run(debug=False, host='0.0.0.0', port=port)